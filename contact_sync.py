@@ -1,26 +1,57 @@
 import csv
 import datetime
+import io
+import itertools
+import logging
+import queue
+import threading
 import traceback
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from logging.handlers import QueueHandler, QueueListener
 
 from graph import GraphAPIContactManager
 
+# Worker threads queue their sync results here; a single QueueListener thread
+# started by process_users_concurrently writes them to sync_results.txt
+_result_queue = queue.Queue()
+result_log = logging.getLogger('sync_results')
+result_log.setLevel(logging.INFO)
+result_log.propagate = False
+result_log.addHandler(QueueHandler(_result_queue))
+
+# Map CSV fields to Graph fields where they differ
+CSV_TO_GRAPH_FIELDS = {
+    'Given Name': 'givenName',
+    'Surname': 'surname',
+    'Mobile': 'mobilePhone',
+    'Business Phone': 'businessPhones',
+    'Job Title': 'jobTitle',
+    'Department': 'department'
+}
+
+# Fields compared between the Graph contacts and the CSV contacts
+COMPARED_FIELDS = ('givenName', 'surname', 'mobilePhone',
+                   'businessPhones', 'jobTitle', 'department')
+
 
 class ContactSync:
     '''Class to handle contacts synchronization between a csv file and the Microsoft Graph API.'''
 
-    def __init__(self, client_id, client_secret, tenant_id):
+    def __init__(self, client_id, client_secret, tenant_id, max_workers=10):
         self.gcm = GraphAPIContactManager(client_id, client_secret, tenant_id)
+        # Number of users synced at the same time
+        self.max_workers = max_workers
+        # Cache of user id -> "Work Contacts" folder id, shared by the worker threads.
+        # It is cleared at the start of every sync, so a folder deleted or recreated
+        # in Outlook is looked up again on the next sync.
+        self._folder_cache = {}
+        self._folder_lock = threading.Lock()
 
     def read_csv_file(self, file_path):
-        ''' Read a csv file and convert it to a list of dictionaries.'''
-        contacts = []
-        with open(file_path, 'r') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                contacts.append(row)
-        return contacts
+        ''' Read a csv file, yielding each row as a dictionary.'''
+        with open(file_path, 'r', newline='') as file:
+            yield from csv.DictReader(file)
 
     def write_to_csv(self, contacts, file_path):
         """This method writes the contact list to a CSV file"""
@@ -40,46 +71,97 @@ class ContactSync:
             for contact in contacts:
                 writer.writerow(contact)
 
+    def is_valid_user(self, user):
+        '''Check that a user has all the fields needed to be synced.'''
+        # users need a mail, givenName and surname,
+        # and a department, job title and office location
+        return bool(user.get('mail') and user.get('givenName') and user.get('surname')
+                    and user.get('department') and user.get('jobTitle') and user.get('officeLocation'))
+
     def filter_users(self):
         '''Get users from the Graph API and format them.'''
-        users = self.gcm.get_users()
-        users = [u for u in users if u.get('mail')]
-        # remove users that do not have a givenName and surname
-        users = [u for u in users if u.get('givenName') and u.get('surname')]
-        # remove users that do not have a department and job title and office location
-        users = [u for u in users if u.get('department') and u.get(
-            'jobTitle') and u.get('officeLocation')]
+        users = [u for u in self.gcm.get_users() if self.is_valid_user(u)]
         # print(f"Total users: {len(users)}")
         return users
 
     def get_user_folder_id(self, user_id):
         '''Get the folder id for a user. If the folder does not exist, create it. '''
+        with self._folder_lock:
+            if user_id in self._folder_cache:
+                return self._folder_cache[user_id]
+
         folders = self.gcm.get_users_folder_id(user_id)
         # if folder name "Work Contacts" exists, return the folder id otherwise create it
         for folder in folders:
             if folder['displayName'] == 'Work Contacts':
-                return folder['id']
-        # create the folder
-        created_folder = self.gcm.create_contact_folder(
-            user_id, 'Work Contacts')
-        return created_folder['id']
+                folder_id = folder['id']
+                break
+        else:
+            # create the folder
+            created_folder = self.gcm.create_contact_folder(
+                user_id, 'Work Contacts')
+            folder_id = created_folder['id']
+
+        with self._folder_lock:
+            self._folder_cache[user_id] = folder_id
+        return folder_id
+
+    def get_user_folder_ids(self, user_ids):
+        '''Resolve the folder ids for many users at once using batch requests.
+
+        Folders are looked up in batches of 20 users and any missing "Work Contacts"
+        folders are created in a second set of batches. Resolved ids are stored in
+        the folder cache; users that fail here are left to get_user_folder_id.'''
+        with self._folder_lock:
+            user_ids = [user_id for user_id in dict.fromkeys(user_ids)
+                        if user_id not in self._folder_cache]
+        if not user_ids:
+            return
+
+        folder_ids = {}
+        missing = []
+        responses = self.gcm.execute_batch_requests(
+            [self.gcm.prepare_get_contact_folders_request(user_id) for user_id in user_ids])
+        for response in responses:
+            if response['status'] != 200:
+                continue
+            folder_id = next((folder['id'] for folder in response['body'].get('value', [])
+                              if folder['displayName'] == 'Work Contacts'), None)
+            if folder_id:
+                folder_ids[response['id']] = folder_id
+            else:
+                missing.append(response['id'])
+
+        if missing:
+            responses = self.gcm.execute_batch_requests(
+                [self.gcm.prepare_create_contact_folder_request(user_id, 'Work Contacts') for user_id in missing])
+            for response in responses:
+                if response['status'] == 201:
+                    folder_ids[response['id']] = response['body']['id']
+
+        with self._folder_lock:
+            self._folder_cache.update(folder_ids)
 
     def get_user_contacts(self, user_id, folder_id):
         '''Get the contacts for a user.'''
-        user_contacts = self.gcm.get_user_contacts(user_id, folder_id)
-        return user_contacts
+        return self.gcm.get_user_contacts(user_id, folder_id)
 
     def delete_user_contacts(self, user_id, contacts, folder_id):
         '''Delete the contacts for a user.'''
+        if not contacts:
+            return []
         delete_contacts = []
         for contact in contacts:
             delete_contacts.append(self.gcm.prepare_delete_contact_request(
                 user_id, contact['id'], folder_id))
-        response = self.gcm.execute_batch_requests(delete_contacts)
+        response = self.gcm.execute_batch_requests(
+            delete_contacts, keep_bodies=False)
         return response
 
     def add_user_contacts(self, user_id, contacts, folder_id):
         '''Add the contacts for a user.'''
+        if not contacts:
+            return []
         add_contacts = []
         for contact in contacts:
             add_contacts.append(self.gcm.prepare_create_contact_request(
@@ -89,35 +171,38 @@ class ContactSync:
 
     def update_user_contacts(self, user_id, contacts, folder_id):
         '''Update the contacts for a user.'''
+        if not contacts:
+            return []
         update_contacts = []
         for contact, contact_id, differences in contacts:
             update_contacts.append(self.gcm.prepare_update_contact_request(
                 user_id, differences, folder_id, contact_id))
-        response = self.gcm.execute_batch_requests(update_contacts)
+        response = self.gcm.execute_batch_requests(
+            update_contacts, keep_bodies=False)
         return response
 
+    def format_contact(self, contact):
+        '''Format a single contact to match the Graph API schema.'''
+        return {
+            "givenName": contact.get('givenName', ""),
+            "surname": contact.get('surname', ""),
+            "emailAddresses": [
+                {
+                    "address": contact.get('mail', ""),
+                    "name": (contact.get('givenName', "") + ' ' + contact.get('surname', "")).strip()
+                }
+            ],
+            "mobilePhone": contact.get('mobilePhone', ""),
+            "businessPhones": [contact.get('businessPhones', "")],
+            "jobTitle": contact.get('jobTitle', ""),
+            "department": contact.get('department', ""),
+            "officeLocation": contact.get('officeLocation', "")
+        }
+
     def format_contact_list(self, contacts):
-        '''Format the contacts to match the Graph API schema.'''
-        formatted_contacts = []
+        '''Format the contacts to match the Graph API schema, yielding them one at a time.'''
         for contact in contacts:
-            formatted_contact = {
-                "givenName": contact.get('givenName', ""),
-                "surname": contact.get('surname', ""),
-                "emailAddresses": [
-                    {
-                        "address": contact.get('mail', ""),
-                        "name": (contact.get('givenName', "") + ' ' + contact.get('surname', "")).strip()
-                    }
-                ],
-                "mobilePhone": contact.get('mobilePhone', ""),
-                "businessPhones": [contact.get('businessPhones', "")],
-                "jobTitle": contact.get('jobTitle', ""),
-                "department": contact.get('department', ""),
-                "officeLocation": contact.get('officeLocation', "")
-            }
-            formatted_contacts.append(formatted_contact)
-            # print(formatted_contacts)
-        return formatted_contacts
+            yield self.format_contact(contact)
 
     def format_user_contacts(self, contacts):
         '''Format the users contacts to match the contacts list schema.'''
@@ -146,73 +231,81 @@ class ContactSync:
             return next((str(phone).strip() for phone in contact.get(field, []) if phone), '')
         else:
             # Default case for fields that are directly accessible
-            return str(contact.get(self.csv_to_graph_field_map(field) if csv else field, '')).strip()
+            return str(contact.get(CSV_TO_GRAPH_FIELDS.get(field, field) if csv else field, '')).strip()
+
+    def get_comparison_values(self, contact, csv=False):
+        '''Get the normalized values of the compared fields of a contact as a tuple.'''
+        return tuple(self.get_field_value(contact, field, csv) for field in COMPARED_FIELDS)
+
+    def get_contact_email(self, contact):
+        '''Get the normalized (stripped, lowercase) email address of a contact.'''
+        email_addresses = contact.get('emailAddresses') or [{}]
+        return (email_addresses[0].get('address') or '').strip().lower()
+
+    def index_contacts(self, contacts):
+        '''Index the formatted CSV contacts by their normalized email address.'''
+        return {self.get_contact_email(c): c for c in contacts}
+
+    def compare_contacts(self, user_contacts, csv_emails, csv_values=None):
+        '''Compare the contacts from the Graph API and the CSV file.
+
+        csv_emails is the CSV contacts indexed by email, as built by index_contacts.
+        csv_values optionally maps the same emails to the precomputed
+        get_comparison_values of each CSV contact.'''
+        if csv_values is None:
+            csv_values = {}
 
-    def compare_contacts(self, user_contacts, csv_contacts):
-        '''Compare the contacts from the Graph API and the CSV file.'''
         user_emails = {}
         duplicates = []
 
         for contact in user_contacts:
-            email = contact['emailAddresses'][0]['address']
+            email = self.get_contact_email(contact)
             if email in user_emails:
                 duplicates.append(contact)
             else:
                 user_emails[email] = contact
 
-        csv_emails = {c['emailAddresses'][0]
-                      ['address']: c for c in csv_contacts}
-
-        to_add = [c for c in csv_contacts if c['emailAddresses']
-                  [0]['address'] not in user_emails]
+        to_add = [csv_emails[email]
+                  for email in csv_emails.keys() - user_emails.keys()]
 
         to_delete = [user_emails[email]
-                     for email in user_emails if email not in csv_emails] + duplicates
+                     for email in user_emails.keys() - csv_emails.keys()] + duplicates
 
         to_update = []
-        for email, contact in csv_emails.items():
-            if email in user_emails:
-                differences = self.get_contact_differences(
-                    user_emails[email], contact)
-                if differences:
-                    to_update.append(
-                        (contact, user_emails[email]['id'], differences))
+        for email in csv_emails.keys() & user_emails.keys():
+            contact = csv_emails[email]
+            differences = self.get_contact_differences(
+                user_emails[email], contact, csv_values.get(email))
+            if differences:
+                to_update.append(
+                    (contact, user_emails[email]['id'], differences))
 
         return to_add, to_delete, to_update
 
-    def get_contact_differences(self, graph_contact, csv_contact):
+    def get_contact_differences(self, graph_contact, csv_contact, csv_values=None):
         '''Get the differences between the graph contact and the csv contact.'''
-        fields = ['givenName', 'surname', 'mobilePhone',
-                  'businessPhones', 'jobTitle', 'department']
-        differences = {}
+        # Get the field values from the graph contact and the CSV contact
+        graph_values = self.get_comparison_values(graph_contact)
+        if csv_values is None:
+            csv_values = self.get_comparison_values(csv_contact, csv=True)
 
-        for field in fields:
-            # Get the field value from the graph contact
-            graph_value = self.get_field_value(graph_contact, field)
-            # Get the field value from the CSV contact
-            csv_value = self.get_field_value(csv_contact, field, csv=True)
+        # Most contacts are already in sync, compare the whole row first
+        if graph_values == csv_values:
+            return {}
 
+        differences = {}
+        for field, graph_value, csv_value in zip(COMPARED_FIELDS, graph_values, csv_values):
             if graph_value != csv_value:
                 # Add the differences to the differences dictionary
                 differences[field] = csv_value
 
         return differences   # Return the differences
 
-    def csv_to_graph_field_map(self, csv_field):
-        '''Map CSV fields to Graph fields if they differ.'''
-        mapping = {
-            'Given Name': 'givenName',
-            'Surname': 'surname',
-            'Mobile': 'mobilePhone',
-            'Business Phone': 'businessPhones',
-            'Job Title': 'jobTitle',
-            'Department': 'department'
-
-        }
-        return mapping.get(csv_field, csv_field)
-
     def process_users_concurrently(self, users, contacts):
-        '''Process each user in their own thread, potentially in batches.'''
+        '''Process each user in their own thread, potentially in batches.
+
+        users can be any iterable, including a generator. At most twice
+        max_workers users are in flight at once.'''
         # print(users)
 
         def process_user(user):
@@ -226,10 +319,10 @@ class ContactSync:
             print(f"Folder ID: {folder_id}")
 
             # get the contacts for the user
-            user_contacts = self.gcm.get_user_contacts(user_id, folder_id)
+            user_contacts = self.get_user_contacts(user_id, folder_id)
 
             to_add, to_delete, to_update = self.compare_contacts(
-                user_contacts, contacts)
+                user_contacts, csv_emails, csv_values)
 
             add_response = self.add_user_contacts(user_id, to_add, folder_id)
             # print(f"Add response: {add_response}")
@@ -242,44 +335,90 @@ class ContactSync:
                 user_id, to_update, folder_id)
             # print(f"Update response: {update_response.count}")
 
-            # write to_add, to_delete, and differences to a file
-            with open('sync_results.txt', 'a') as file:
-                file.write(f"\n\nUser: {user_displayName}\n")
-                file.write(f"Timestamp: {datetime.datetime.now()}\n")
-                file.write("Contacts to add:\n")
-                for contact, response in zip(to_add, add_response):
-                    file.write(f"\tContact: {contact}\n")
-                    file.write(f"\tResponse: {response}\n")
-                file.write("Contacts to delete:\n")
-                for contact, response in zip(to_delete, delete_response):
-                    file.write(f"\tContact: {contact}\n")
-                    file.write(f"\tResponse: {response}\n")
-                file.write("Contacts to update:\n")
-                for contact, response in zip(to_update, update_response):
-                    file.write(f"\tContact: {contact}\n")
-                    file.write(f"\tResponse: {response}\n")
+            # Nothing changed for this user, skip the results log entry
+            if not (to_add or to_delete or to_update):
+                return
+
+            # write to_add, to_delete, and differences to the results log as one record
+            file = io.StringIO()
+            file.write(f"\n\nUser: {user_displayName}\n")
+            file.write(f"Timestamp: {datetime.datetime.now()}\n")
+            file.write("Contacts to add:\n")
+            for contact, response in zip(to_add, add_response):
+                file.write(f"\tContact: {contact}\n")
+                file.write(f"\tResponse: {response}\n")
+            file.write("Contacts to delete:\n")
+            for contact, response in zip(to_delete, delete_response):
+                file.write(f"\tContact: {contact}\n")
+                file.write(f"\tResponse: {response}\n")
+            file.write("Contacts to update:\n")
+            for contact, response in zip(to_update, update_response):
+                file.write(f"\tContact: {contact}\n")
+                file.write(f"\tResponse: {response}\n")
+            result_log.info(file.getvalue())
 
             # uncomment the following lines to delete all contacts
             # response = self.delete_user_contacts(
             #     user_id, user_contacts, folder_id)
 
-        with ThreadPoolExecutor(max_workers=20) as executor:
-            future_to_user = {executor.submit(
-                process_user, user): user for user in users}
-            for future in as_completed(future_to_user):
-                user = future_to_user[future]
-                try:
-                    future.result()
-                except Exception as exc:
-                    user_principal_name = user.get(
-                        'userPrincipalName', 'Unknown User')
-                    print(f"{user_principal_name} generated an exception: {exc}")
-                    # Log the exception details for robust error handling
-                    with open('error_log.txt', 'a') as file:
-                        file.write(f"\n\nUser: {user_principal_name}\n")
-                        file.write(f"Timestamp: {datetime.datetime.now()}\n")
-                        file.write(f"Exception: {exc}\n")
-                        traceback.print_exc(file=file)
-                else:
-                    # TODO: update the GUI that the user has been processed so GUI can reduce count
-                    pass
+        # Folders may have been deleted or recreated since the last sync
+        with self._folder_lock:
+            self._folder_cache.clear()
+
+        # Index the CSV contacts once, every worker compares against the same dict
+        csv_emails = self.index_contacts(contacts)
+        csv_values = {email: self.get_comparison_values(contact, csv=True)
+                      for email, contact in csv_emails.items()}
+
+        def prefetch_folder_ids(users):
+            '''Resolve the folders of the next users in a few batch requests.'''
+            try:
+                self.get_user_folder_ids(
+                    [user['id'] for user in users if user.get('id')])
+            except Exception as exc:
+                print(f"Batch folder lookup failed, resolving folders per user: {exc}")
+
+        results_handler = logging.FileHandler('sync_results.txt')
+        # Each record is a complete, already newline-terminated block
+        results_handler.terminator = ''
+        listener = QueueListener(_result_queue, results_handler)
+        listener.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                users = iter(users)
+                future_to_user = {}
+                while True:
+                    # Once the in-flight window has drained to max_workers, top it
+                    # back up to twice that from the users iterator
+                    if len(future_to_user) <= self.max_workers:
+                        next_users = list(itertools.islice(
+                            users, 2 * self.max_workers - len(future_to_user)))
+                        if next_users:
+                            prefetch_folder_ids(next_users)
+                        for user in next_users:
+                            future_to_user[executor.submit(
+                                process_user, user)] = user
+                    if not future_to_user:
+                        break
+
+                    done, _ = wait(future_to_user, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        user = future_to_user.pop(future)
+                        try:
+                            future.result()
+                        except Exception as exc:
+                            user_principal_name = user.get(
+                                'userPrincipalName', 'Unknown User')
+                            print(f"{user_principal_name} generated an exception: {exc}")
+                            # Log the exception details for robust error handling
+                            with open('error_log.txt', 'a') as file:
+                                file.write(f"\n\nUser: {user_principal_name}\n")
+                                file.write(f"Timestamp: {datetime.datetime.now()}\n")
+                                file.write(f"Exception: {exc}\n")
+                                traceback.print_exc(file=file)
+                        else:
+                            # TODO: update the GUI that the user has been processed so GUI can reduce count
+                            pass
+        finally:
+            listener.stop()
+            results_handler.close()
@@ -1,15 +1,66 @@
 '''graph.py'''
+import atexit
+import gzip
 import requests
+import itertools
 import json
-import uuid
-import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the standard library
+    orjson = None
+
+# Status codes Graph uses for throttling and transient failures. Requests (or
+# batch sub-requests) that come back with one of these are retried.
+RETRYABLE_STATUS_CODES = {429, 503, 504}
+
+# Request bodies smaller than this are never gzip compressed
+GZIP_MIN_BYTES = 4096
+
+# Fields that are never sent in the body of a create contact request
+CREATE_CONTACT_SKIP_FIELDS = frozenset(("id", "businessPhones"))
+
+# String values that are treated as missing in contact request bodies
+INVALID_STRING_VALUES = frozenset(("", "nan"))
+
+
+def json_dumps(obj):
+    """Serialize obj to compact JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def json_loads(data):
+    """Parse JSON bytes or str, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def is_valid_value(value):
+    """Check that a value is not None, an empty string, "nan" or a float NaN."""
+    if value is None:
+        return False
+    if isinstance(value, str):
+        return value not in INVALID_STRING_VALUES
+    if isinstance(value, float):
+        return value == value  # NaN is the only value not equal to itself
+    return True
+
 
 class GraphAPIContactManager:
     """A class to manage contacts using Graph API with token management."""
 
-    def __init__(self, client_id, client_secret, tenant_id):
+    def __init__(self, client_id, client_secret, tenant_id, max_retries=5, backoff_base=1.0, pool_size=40, max_concurrent_batches=1, rate_limit_threshold=20, compress_requests=False, timeout=30):
         """Initialize the manager with client credentials."""
         # Store the client ID, client secret, and tenant ID
         self.client_id = client_id
@@ -26,97 +77,246 @@ class GraphAPIContactManager:
         # Initialize the token and token expiry to None
         self.token = None
         self.token_expiry = datetime.utcnow()
+        # Cached (token, monotonic deadline) pair read by get_token's fast path
+        self._token_state = (None, 0.0)
+        # Guards token refresh so concurrent workers don't all fetch a token
+        self._token_lock = threading.Lock()
+
+        # Batch request ids only have to be unique within a batch, a counter is enough
+        self._request_ids = itertools.count()
+
+        # Retry settings for throttled requests (429/503/504)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+
+        # Pooled session shared by all worker threads so every call reuses an
+        # open TCP/TLS connection instead of doing a new handshake
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        atexit.register(self.session.close)
+        # Seconds to wait for Graph to respond. A Session has no default timeout,
+        # so without it one stalled socket would hang its worker forever.
+        self.timeout = timeout
+
+        # Number of batches of one execute_batch_requests call sent at the same time.
+        # Outlook allows at most 4 concurrent requests per mailbox and every
+        # sub-request of a batch counts against it, so a single batch to one
+        # mailbox can already exceed it. The add/delete/update batches all target
+        # one user's mailbox, so they are sent one after the other by default;
+        # the sync gets its parallelism from processing several users at once.
+        self.max_concurrent_batches = max_concurrent_batches
+
+        # Client-side throttling driven by the RateLimit-* headers Graph returns.
+        # When fewer than rate_limit_threshold requests remain, no batch is sent
+        # until the reported reset time (a monotonic timestamp) has passed.
+        self.rate_limit_threshold = rate_limit_threshold
+        self._rate_condition = threading.Condition()
+        self._rate_resume_at = 0.0
+
+        # Gzip large batch bodies; off by default, enable only if the tenant accepts it
+        self.compress_requests = compress_requests
 
     def get_token(self):
         """Generate a new token using client credentials."""
-        if self.token is None or datetime.utcnow() >= self.token_expiry:
-            payload = {
-                'grant_type': 'client_credentials',
-                'client_id': self.client_id,
-                'client_secret': self.client_secret,
-                'scope': 'https://graph.microsoft.com/.default'
+        # Fast path, no lock needed while the cached token is still fresh
+        token, valid_until = self._token_state
+        if token is not None and time.monotonic() < valid_until:
+            return token
+
+        with self._token_lock:
+            # Re-check, another thread may have refreshed the token while we waited
+            token, valid_until = self._token_state
+            if token is None or time.monotonic() >= valid_until:
+                payload = {
+                    'grant_type': 'client_credentials',
+                    'client_id': self.client_id,
+                    'client_secret': self.client_secret,
+                    'scope': 'https://graph.microsoft.com/.default'
+                }
+                response = self.session.post(self.token_url, data=payload, timeout=self.timeout)
+                response.raise_for_status()  # Raise an exception for HTTP errors
+                token_response = json_loads(response.content)  # Parse the JSON response
+                # Store the access token
+                self.token = token_response['access_token']
+                # Get the token expiry time
+                expires_in = token_response['expires_in']
+                self.token_expiry = datetime.utcnow(
+                ) + timedelta(seconds=expires_in - 300)  # Buffer time
+                # Publish the token and its deadline together so readers never see a mismatched pair
+                self._token_state = (
+                    self.token, time.monotonic() + expires_in - 300)
+
+            return self._token_state[0]
+
+    def retry_delay(self, attempt, retry_after=None):
+        """Return the seconds to wait before the given retry attempt.
+
+        Uses exponential backoff with jitter, but never waits less than the
+        Retry-After value sent by Graph."""
+        try:
+            retry_after = int(retry_after or 0)
+        except ValueError:
+            retry_after = 0
+        return max(retry_after, self.backoff_base * 2 ** attempt) + random.uniform(0, 0.5)
+
+    def update_rate_limit(self, headers):
+        """Record the RateLimit-* headers of a response and pause if the limit is nearly used."""
+        headers = CaseInsensitiveDict(headers or {})
+        try:
+            remaining = int(headers['RateLimit-Remaining'])
+            reset = int(headers.get('RateLimit-Reset', 1))
+        except (KeyError, ValueError):
+            return
+        if remaining < self.rate_limit_threshold:
+            with self._rate_condition:
+                self._rate_resume_at = max(
+                    self._rate_resume_at, time.monotonic() + reset)
+
+    def wait_for_rate_limit(self):
+        """Block until the rate limit window recorded by update_rate_limit has reset."""
+        with self._rate_condition:
+            while True:
+                delay = self._rate_resume_at - time.monotonic()
+                if delay <= 0:
+                    return
+                self._rate_condition.wait(delay)
+
+    def post_with_retry(self, url, payload):
+        """POST a JSON payload to Graph, retrying throttled responses."""
+        # Serialize once, compactly, and reuse the same body for every attempt
+        data = json_dumps(payload)
+        extra_headers = {}
+        if self.compress_requests and len(data) > GZIP_MIN_BYTES:
+            data = gzip.compress(data, compresslevel=3)
+            extra_headers['Content-Encoding'] = 'gzip'
+
+        for attempt in range(self.max_retries + 1):
+            self.wait_for_rate_limit()
+            headers = {
+                'Authorization': f'Bearer {self.get_token()}',
+                'Content-Type': 'application/json',
+                **extra_headers
             }
-            response = requests.post(self.token_url, data=payload)
-            response.raise_for_status()  # Raise an exception for HTTP errors
-            token_response = response.json()  # Parse the JSON response
-            # Store the access token
-            self.token = token_response['access_token']
-            # Get the token expiry time
-            expires_in = token_response['expires_in']
-            self.token_expiry = datetime.utcnow(
-            ) + timedelta(seconds=expires_in - 300)  # Buffer time
-
-        return self.token
+            response = self.session.post(url, headers=headers, data=data, timeout=self.timeout)
+            self.update_rate_limit(response.headers)
+            if response.status_code not in RETRYABLE_STATUS_CODES or attempt == self.max_retries:
+                return response
+            time.sleep(self.retry_delay(
+                attempt, response.headers.get('Retry-After')))
 
     def batch_request(self, requests_list):
         """Send a batch request to Graph API."""
-        token = self.get_token()
-        headers = {
-            'Authorization': f'Bearer {token}',
-            'Content-Type': 'application/json'
-        }
         # Ensure request bodies are properly serialized for POST requests
         for request in requests_list:
             if 'body' in request and request['method'] == 'POST':
-                request['body'] = json.dumps(request['body'])
+                request['body'] = json_dumps(request['body']).decode('utf-8')
 
         batch_payload = requests_list
         # print(batch_payload)  # Debugging
-        response = requests.post(
-            f"{self.api_url}$batch",
-            headers=headers,
-            json=batch_payload
-        )
+        response = self.post_with_retry(f"{self.api_url}$batch", batch_payload)
+
+        # Decode the body once, it is needed on both the success and error paths
+        try:
+            data = json_loads(response.content)
+        except ValueError:
+            data = {}
 
         try:
             response.raise_for_status()
         except requests.exceptions.HTTPError as e:
             error_message = f"HTTP Error: {
                 e.response.status_code} - {e.response.reason}"
-            if 'error' in e.response.json():
-                error_message += f"\nError Message: {
-                    e.response.json()['error']['message']}"
+            error = data.get('error') if isinstance(data, dict) else None
+            if isinstance(error, dict) and error.get('message'):
+                error_message += f"\nError Message: {error['message']}"
             raise Exception(error_message)
 
-        return response.json()
+        return data
 
-    def execute_batch_requests(self, prepared_requests, chunk_size=20):
-        """Execute prepared requests in batches."""
+    def send_batch(self, chunk, keep_bodies=True):
+        """Send a single batch of requests, retrying throttled sub-requests.
+
+        Only the sub-requests that came back with a retryable status are sent
+        again. The responses are returned in the same order as the chunk.
+        With keep_bodies=False successful responses are trimmed to their id,
+        status and headers; error responses always keep their body."""
+        requests_by_id = {request['id']: request for request in chunk}
+        responses = {}
+        pending = chunk
+
+        for attempt in range(self.max_retries + 1):
+            batch_response = self.post_with_retry(
+                f"{self.api_url}$batch", {"requests": pending})
+            # print(batch_response)
+            batch_response.raise_for_status()
+            batch_responses = json_loads(batch_response.content)
+
+            if 'responses' not in batch_responses:
+                print(f"Error or unexpected response format in batch: {
+                      batch_responses}")
+                break
+
+            retryable = []
+            retry_after = 0
+            for response in batch_responses['responses']:
+                self.update_rate_limit(response.get('headers'))
+                if not keep_bodies and response['status'] < 400:
+                    response = {key: response[key] for key in (
+                        'id', 'status', 'headers') if key in response}
+                responses[response['id']] = response
+                if response['status'] in RETRYABLE_STATUS_CODES:
+                    retryable.append(requests_by_id[response['id']])
+                    headers = CaseInsensitiveDict(response.get('headers', {}))
+                    try:
+                        retry_after = max(
+                            retry_after, int(headers.get('Retry-After', 0)))
+                    except ValueError:
+                        pass
+
+            if not retryable or attempt == self.max_retries:
+                break
+            time.sleep(self.retry_delay(attempt, retry_after))
+            pending = retryable
+
+        return [responses[request['id']] for request in chunk if request['id'] in responses]
+
+    def execute_batch_requests(self, prepared_requests, chunk_size=20, keep_bodies=True):
+        """Execute prepared requests in batches.
+
+        Pass keep_bodies=False when only the status of successful requests is needed."""
         def chunk_requests(reqs, size):
             """Yield successive size chunks from reqs."""
             for i in range(0, len(reqs), size):
                 yield reqs[i:i + size]
 
-        all_responses = []
+        if not prepared_requests:
+            return []
 
-        for chunk in chunk_requests(prepared_requests, chunk_size):
-            batch_payload = {"requests": chunk}
-            # Debug print to verify payload
-            # print(f"Sending batch payload: {batch_payload}\n\n")
+        chunks = list(chunk_requests(prepared_requests, chunk_size))
+        all_responses = []
 
-            token = self.get_token()
-            headers = {
-                'Authorization': f'Bearer {token}',
-                'Content-Type': 'application/json'
-            }
-            try:
-                batch_response = requests.post(
-                    f"{self.api_url}$batch",
-                    headers=headers,
-                    json=batch_payload
-                )
-                # print(batch_response)
-                batch_response.raise_for_status()
-                batch_responses = batch_response.json()
-
-                if 'responses' in batch_responses:
-                    all_responses.extend(batch_responses['responses'])
-                else:
-                    print(f"Error or unexpected response format in batch: {
-                          batch_responses}")
-            except requests.exceptions.RequestException as e:
-                print(f"Error occurred during batch request: {e}")
-                raise
+        # A single chunk, the common case, or no concurrency: send the chunks inline
+        if len(chunks) == 1 or self.max_concurrent_batches <= 1:
+            for chunk in chunks:
+                try:
+                    all_responses.extend(self.send_batch(chunk, keep_bodies))
+                except requests.exceptions.RequestException as e:
+                    print(f"Error occurred during batch request: {e}")
+                    raise
+            return all_responses
+
+        # Send the chunks concurrently, but collect the results in submission
+        # order so the responses line up with prepared_requests
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_batches) as executor:
+            futures = [executor.submit(self.send_batch, chunk, keep_bodies)
+                       for chunk in chunks]
+            for future in futures:
+                try:
+                    all_responses.extend(future.result())
+                except requests.exceptions.RequestException as e:
+                    print(f"Error occurred during batch request: {e}")
+                    raise
 
         # for response in all_responses:
             # print(response)
@@ -151,21 +351,12 @@ class GraphAPIContactManager:
 
     def prepare_create_contact_request(self, user_id, contact, folder_id):
         """Prepare a request payload for creating a contact."""
-
-        def is_valid_value(value):
-            # Checks if the value is not None, not an empty string, and not nan
-            if value in [None, "", "nan"]:
-                return False
-            if isinstance(value, float) and math.isnan(value):
-                return False
-            return True
-
         # Exclude 'businessPhones' field if it is blank, null, or NaN
-        body = {k: v for k, v in contact.items() if k != "id" and k !=
-                "businessPhones" and is_valid_value(v)}
+        body = {k: v for k, v in contact.items()
+                if k not in CREATE_CONTACT_SKIP_FIELDS and is_valid_value(v)}
 
         return {
-            "id": str(uuid.uuid4()),  # Convert UUID to string
+            "id": str(next(self._request_ids)),
             "url": f"/users/{user_id}/contactFolders/{folder_id}/contacts",
             "method": "POST",
             "body": body,
@@ -174,15 +365,6 @@ class GraphAPIContactManager:
 
     def prepare_update_contact_request(self, user_id, contact_differences, folder_id, contact_id):
         """Prepare a request payload for updating a contact."""
-
-        def is_valid_value(value):
-            # Checks if the value is not None, not an empty string, and not nan
-            if value in [None, "", "nan"]:
-                return False
-            if isinstance(value, float) and math.isnan(value):
-                return False
-            return True
-
         # Create a new body dictionary handling 'businessPhones' and 'mobilePhone' specifically.
         body = {
             k: v for k, v in contact_differences.items() if is_valid_value(v)
@@ -203,7 +385,7 @@ class GraphAPIContactManager:
             body['mobilePhone'] = body['mobilePhone']
 
         return {
-            "id": str(uuid.uuid4()),  # Request ID, correctly generated here
+            "id": str(next(self._request_ids)),  # Request ID, unique within the batch
             "url": f"/users/{user_id}/contactFolders/{folder_id}/contacts/{contact_id}",
             "method": "PATCH",
             "body": body,
@@ -214,7 +396,7 @@ class GraphAPIContactManager:
         """Prepare a request payload for deleting a contact."""
         # Ensure contact_id is a valid, existing contact ID from Graph API.
         return {
-            "id": str(uuid.uuid4()),  # Request ID, correctly generated here
+            "id": str(next(self._request_ids)),  # Request ID, unique within the batch
             "url": f"/users/{user_id}/contactFolders/{folder_id}/contacts/{contact_id}",
             "method": "DELETE"
         }
@@ -228,9 +410,9 @@ class GraphAPIContactManager:
             self.api_url}users?$select=id,givenName,surname,department,jobTitle,officeLocation,mobilePhone,businessPhones,mail"
 
         while api_endpoint:
-            response = requests.get(api_endpoint, headers=headers)
+            response = self.session.get(api_endpoint, headers=headers, timeout=self.timeout)
             response.raise_for_status()
-            data = response.json()
+            data = json_loads(response.content)
             # Assuming 'value' contains the users list
             users.extend(data['value'])
 
@@ -246,9 +428,9 @@ class GraphAPIContactManager:
         api_endpoint = f"{
             self.api_url}users/{upn}"
 
-        response = requests.get(api_endpoint, headers=headers)
+        response = self.session.get(api_endpoint, headers=headers, timeout=self.timeout)
         response.raise_for_status()
-        data = response.json()
+        data = json_loads(response.content)
 
         return data
 
@@ -261,9 +443,9 @@ class GraphAPIContactManager:
 
         contacts = []
         while api_endpoint:
-            response = requests.get(api_endpoint, headers=headers)
+            response = self.session.get(api_endpoint, headers=headers, timeout=self.timeout)
             response.raise_for_status()
-            data = response.json()
+            data = json_loads(response.content)
             contacts.extend(data['value'])
             api_endpoint = data.get('@odata.nextLink')
 
@@ -276,9 +458,9 @@ class GraphAPIContactManager:
         api_endpoint = f"{
             self.api_url}users/{user_id}/contactFolders"
 
-        response = requests.get(api_endpoint, headers=headers)
+        response = self.session.get(api_endpoint, headers=headers, timeout=self.timeout)
         response.raise_for_status()
-        data = response.json()
+        data = json_loads(response.content)
         return data['value']
 
     def create_contact_folder(self, user_id, folder_name):
@@ -290,7 +472,8 @@ class GraphAPIContactManager:
         }
         api_endpoint = f"{
             self.api_url}users/{user_id}/contactFolders"
-        payload = json.dumps({"displayName": folder_name})
-        response = requests.post(api_endpoint, headers=headers, data=payload)
+        payload = json_dumps({"displayName": folder_name})
+        response = self.session.post(
+            api_endpoint, headers=headers, data=payload, timeout=self.timeout)
         response.raise_for_status()
-        return response.json()
+        return json_loads(response.content)
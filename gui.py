@@ -1,10 +1,161 @@
 import os
 import re
 import json
-from PyQt5.QtWidgets import QWidget, QTableWidget, QTableWidgetItem, QVBoxLayout, QHBoxLayout, QPushButton, QHeaderView, QFrame, QMainWindow, QLabel, QAbstractItemView
-from PyQt5.QtCore import Qt, pyqtSignal, QThread, QItemSelectionModel
+from pathlib import Path
+from PyQt5.QtWidgets import QWidget, QTableView, QVBoxLayout, QHBoxLayout, QPushButton, QHeaderView, QFrame, QMainWindow, QLabel, QAbstractItemView
+from PyQt5.QtCore import Qt, pyqtSignal, QObject, QThread, QRunnable, QThreadPool, QItemSelection, QItemSelectionModel, QAbstractTableModel, QModelIndex, QSortFilterProxyModel
 
 from contact_sync import ContactSync
+from graph import json_dumps, json_loads
+
+# Matches every non-digit character of a phone number
+NON_DIGIT_RE = re.compile(r'\D')
+
+# Column headers and the contact/user dict key shown in each column
+CONTACT_HEADERS = ('Given Name', 'Surname', 'Email', 'Business Phone',
+                   'Mobile', 'Department', 'Job Title', 'Office Location')
+CONTACT_COLS = ('givenName', 'surname', 'mail', 'businessPhones',
+                'mobilePhone', 'department', 'jobTitle', 'officeLocation')
+# Contact table columns whose values get formatted as phone numbers on save
+BUSINESS_PHONE_COL = CONTACT_COLS.index('businessPhones')
+MOBILE_PHONE_COL = CONTACT_COLS.index('mobilePhone')
+# The user table has an extra checkbox column in front
+USER_HEADERS = ('Check',) + CONTACT_HEADERS
+USER_COLS = (None,) + CONTACT_COLS
+# How long closing the main window waits for a running load, in milliseconds
+LOAD_WAIT_MS = 1000
+
+
+def cell_text(value):
+    """Return the text shown in a table cell for a value, skipping str() for values that already are strings."""
+    return value if isinstance(value, str) else str(value)
+
+
+class DictTableModel(QAbstractTableModel):
+    """Table model showing a list of dicts, one row per dict and one column per key."""
+
+    def __init__(self, headers, keys, rows=None, editable=False, parent=None):
+        """Initialize the model with the column headers, the dict key shown in each column and the rows."""
+        super().__init__(parent)
+        self._headers = headers
+        self._keys = keys
+        self._rows = rows if rows is not None else []
+        self._editable = editable
+
+    def rows(self):
+        """Return the list of row dicts backing the model."""
+        return self._rows
+
+    def set_rows(self, rows):
+        """Replace all rows at once with a single model reset."""
+        self.beginResetModel()
+        self._rows = rows
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._keys)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self._headers[section]
+        return super().headerData(section, orientation, role)
+
+    def data(self, index, role=Qt.DisplayRole):
+        # Cell text is only built for the cells the view actually asks for
+        if not index.isValid() or role not in (Qt.DisplayRole, Qt.EditRole):
+            return None
+        key = self._keys[index.column()]
+        if key is None:
+            return None
+        return cell_text(self._rows[index.row()].get(key, 'NONE'))
+
+    def row_text(self, row):
+        """Return the display text of every cell of a row, without going through an index per cell."""
+        values = self._rows[row]
+        return [None if key is None else cell_text(values.get(key, 'NONE')) for key in self._keys]
+
+    def flags(self, index):
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if self._editable:
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid() or role != Qt.EditRole or not self._editable:
+            return False
+        # Write the edited value back into the row dict
+        self._rows[index.row()][self._keys[index.column()]] = value
+        self.dataChanged.emit(index, index, [role])
+        return True
+
+
+class UserTableModel(DictTableModel):
+    """Table model for the user list, with a checkbox in the first column (key None)."""
+
+    def __init__(self, headers, keys, rows=None, checked_ids=None, parent=None):
+        """Initialize the model with the rows and the ids of the users that start checked."""
+        super().__init__(headers, keys, rows, parent=parent)
+        self._checked_ids = set(checked_ids or ())
+
+    def set_rows(self, rows, checked_ids=None):
+        """Replace all rows, and optionally the checked ids, with a single model reset."""
+        if checked_ids is not None:
+            self._checked_ids = set(checked_ids)
+        super().set_rows(rows)
+
+    def checked_ids(self):
+        """Return a copy of the set of checked user ids."""
+        return set(self._checked_ids)
+
+    def set_all_checked(self, checked):
+        """Check or uncheck every user."""
+        if checked:
+            self._checked_ids = {row.get('id') for row in self._rows}
+        else:
+            self._checked_ids = set()
+        self.refresh_check_column()
+
+    def refresh_check_column(self):
+        """Tell the views that the checkbox column changed."""
+        if self._rows:
+            self.dataChanged.emit(self.index(0, 0), self.index(
+                len(self._rows) - 1, 0), [Qt.CheckStateRole])
+
+    def data(self, index, role=Qt.DisplayRole):
+        if index.isValid() and index.column() == 0 and role == Qt.CheckStateRole:
+            return Qt.Checked if self._rows[index.row()].get('id') in self._checked_ids else Qt.Unchecked
+        return super().data(index, role)
+
+    def flags(self, index):
+        if index.isValid() and index.column() == 0:
+            return Qt.ItemIsUserCheckable | Qt.ItemIsEnabled
+        return super().flags(index)
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid() or index.column() != 0 or role != Qt.CheckStateRole:
+            return False
+        user_id = self._rows[index.row()].get('id')
+        if value == Qt.Checked:
+            self._checked_ids.add(user_id)
+        else:
+            self._checked_ids.discard(user_id)
+        self.dataChanged.emit(index, index, [role])
+        return True
+
+
+def sortable_view(model, parent=None):
+    """Create a QTableView showing the model through a sorting proxy."""
+    proxy = QSortFilterProxyModel(parent)
+    proxy.setSourceModel(model)
+    view = QTableView(parent)
+    view.setModel(proxy)
+    # Keep the source order until a header is clicked
+    view.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+    view.setSortingEnabled(True)
+    return view
 
 
 class SyncStatusWindow(QMainWindow):
@@ -31,13 +182,20 @@ class SyncStatusWindow(QMainWindow):
         self.status_label.setText(message)
 
 
-class SyncThread(QThread):
-    """Thread to run the sync process."""
+class WorkerSignals(QObject):
+    """Signals emitted by the runnables. A QRunnable is not a QObject, so it cannot define signals itself."""
     update_signal = pyqtSignal(str)
+    users_signal = pyqtSignal(list)
+    error_signal = pyqtSignal(str)
+
+
+class SyncRunnable(QRunnable):
+    """Runnable to run the sync process on a thread from the global QThreadPool, so threads are reused across syncs."""
 
     def __init__(self, sync_function, contacts, users, *args, **kwargs):
-        '''This method initializes the thread with the sync function, contacts, and users. It also stores any additional arguments and keyword arguments.'''
+        '''This method initializes the runnable with the sync function, contacts, and users. It also stores any additional arguments and keyword arguments.'''
         super().__init__()
+        self.signals = WorkerSignals()
         self.sync_function = sync_function
         self.contacts = contacts
         self.users = users
@@ -45,12 +203,49 @@ class SyncThread(QThread):
         self.kwargs = kwargs
 
     def run(self):
-        '''This method is called when the thread is started. It calls the sync function and emits a signal to update the status.'''
-        self.update_signal.emit(f"Starting sync for {len(self.contacts)} contacts and {
-                                len(self.users)} users...")  # Emit a signal to update the status
+        '''This method is called when the runnable is started. It calls the sync function and emits a signal to update the status.'''
+        self.signals.update_signal.emit(f"Starting sync for {len(self.contacts)} contacts and {
+                                        len(self.users)} users...")  # Emit a signal to update the status
         self.sync_function(self.contacts, self.users)  # Call the sync function
         # Emit a signal to update the status
-        self.update_signal.emit("Sync complete.")
+        self.signals.update_signal.emit("Sync complete.")
+
+
+class UsersRunnable(QRunnable):
+    """Runnable to fetch the latest users from the Graph API on a thread from the global QThreadPool."""
+
+    def __init__(self, contact_sync):
+        '''This method initializes the runnable with the ContactSync instance used to fetch the users.'''
+        super().__init__()
+        self.signals = WorkerSignals()
+        self.contact_sync = contact_sync
+
+    def run(self):
+        '''This method is called when the runnable is started. It emits the users, or the error if they could not be fetched.'''
+        try:
+            users = self.contact_sync.filter_users()
+        except Exception as e:
+            self.signals.error_signal.emit(str(e))
+            return
+        self.signals.users_signal.emit(users)
+
+
+class LoadThread(QThread):
+    """Thread to load the contacts from the CSV file and the users from the Graph API. It runs once at startup."""
+    contacts_signal = pyqtSignal(list)
+    users_signal = pyqtSignal(list)
+
+    def __init__(self, contact_sync, csv_file_path):
+        '''This method initializes the thread with the ContactSync instance and the path of the CSV file.'''
+        super().__init__()
+        self.contact_sync = contact_sync
+        self.csv_file_path = csv_file_path
+
+    def run(self):
+        '''This method is called when the thread is started. It loads the contacts first, since reading the CSV file is fast, then the users.'''
+        self.contacts_signal.emit(
+            list(self.contact_sync.read_csv_file(self.csv_file_path)))
+        self.users_signal.emit(self.contact_sync.filter_users())
 
 
 class UserSyncGUI(QWidget):
@@ -60,12 +255,19 @@ class UserSyncGUI(QWidget):
         super().__init__()
         self.csv_file_path = csv_file_path
         self.checked_users_file = 'checked_users.json'
-        self.checked_users = []
+        self.checked_users = set()
         self.contact_sync = ContactSync(client_id, client_secret, tenant_id)
-        self.users = self.contact_sync.filter_users()
-        self.contacts = self.contact_sync.read_csv_file(csv_file_path)
+        # The users and contacts are loaded in the background so the window shows up right away
+        self.users = []
+        self.users_loaded = False
+        self.rebuild_user_index()
+        self.contacts = []
         self.load_checked_states()
         self.initUI()
+        self.load_thread = LoadThread(self.contact_sync, csv_file_path)
+        self.load_thread.contacts_signal.connect(self.set_contacts)
+        self.load_thread.users_signal.connect(self.set_users)
+        self.load_thread.start()
 
     def initUI(self):
         '''This method sets up the user interface. It creates the widgets and layouts and adds them to the main window.'''
@@ -76,18 +278,17 @@ class UserSyncGUI(QWidget):
         self.contacts_header.setAlignment(Qt.AlignCenter)
         self.contact_table_layout.addWidget(self.contacts_header)
 
-        self.contact_table = QTableWidget(self)
-        self.contact_table.setColumnCount(8)
-        self.contact_table.setHorizontalHeaderLabels([
-            'Given Name', 'Surname', 'Email', 'Business Phone', 'Mobile', 'Department', 'Job Title', 'Office Location'])
+        # The contact rows are edited in place through the model
+        self.contact_model = DictTableModel(
+            CONTACT_HEADERS, CONTACT_COLS, editable=True, parent=self)
+        self.contact_table = sortable_view(self.contact_model, self)
         self.contact_table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
         self.contact_table.verticalHeader().setVisible(False)
         self.contact_table.setAlternatingRowColors(True)
         self.contact_table.setStyleSheet(
             "alternate-background-color: lightgrey; background-color: white;")
-        self.contact_table.setSortingEnabled(True)
         self.populate_contact_table()
-        self.contact_table.setEditTriggers(QTableWidget.AllEditTriggers)
+        self.contact_table.setEditTriggers(QAbstractItemView.AllEditTriggers)
         # Create a button for adding a new contact
         self.save_list_btn = QPushButton('Save Contact List', self)
         # Connect the button to the add_contact method
@@ -105,24 +306,24 @@ class UserSyncGUI(QWidget):
             self.update_contact_list_btn)
         self.contact_table_buttons_layout.addWidget(self.save_list_btn)
         self.contact_table_layout.addLayout(self.contact_table_buttons_layout)
+        # Saving or refreshing before the contacts are loaded would write or show an empty list
+        self.save_list_btn.setEnabled(False)
+        self.refresh_list_btn.setEnabled(False)
 
         self.layout.addLayout(self.contact_table_layout)
         self.user_table_layout = QVBoxLayout()
         # Users Header
-        self.users_header = QLabel("User List")
+        self.users_header = QLabel("User List (loading...)")
         self.users_header.setAlignment(Qt.AlignCenter)
         self.user_table_layout.addWidget(self.users_header)
 
-        self.user_table = QTableWidget(self)
-        self.user_table.setColumnCount(9)
-        self.user_table.setHorizontalHeaderLabels(
-            ['Check', 'Given Name', 'Surname', 'Email', 'Business Phone', 'Mobile', 'Department', 'Job Title', 'Office Location'])
+        self.user_model = UserTableModel(USER_HEADERS, USER_COLS, parent=self)
+        self.user_table = sortable_view(self.user_model, self)
         self.user_table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
         self.user_table.verticalHeader().setVisible(False)
         self.user_table.setAlternatingRowColors(True)
         self.user_table.setStyleSheet(
             "alternate-background-color: lightgrey; background-color: white;")
-        self.user_table.setSortingEnabled(True)
         self.populate_user_table()
 
         self.uncheck_all_btn_user = QPushButton('Uncheck All', self)
@@ -132,6 +333,9 @@ class UserSyncGUI(QWidget):
 
         self.sync_contacts_btn = QPushButton('Sync Contacts', self)
         self.sync_contacts_btn.clicked.connect(self.start_sync_process)
+        # The buttons that need the users stay disabled until they are loaded
+        self.sync_contacts_btn.setEnabled(False)
+        self.update_contact_list_btn.setEnabled(False)
 
         self.user_table_layout.addWidget(self.user_table)
         self.user_table_buttons_layout = QHBoxLayout()
@@ -155,99 +359,74 @@ class UserSyncGUI(QWidget):
 
     def populate_contact_table(self):
         '''This method populates the contact table with the contacts from the CSV file.'''
-        self.contact_table.setRowCount(len(self.contacts))
-
-        for i, contact in enumerate(self.contacts):
-            self.contact_table.setItem(i, 0, QTableWidgetItem(
-                str(contact.get('givenName', 'NONE'))))
-            self.contact_table.setItem(i, 1, QTableWidgetItem(
-                str(contact.get('surname', 'NONE'))))
-            self.contact_table.setItem(i, 2, QTableWidgetItem(
-                str(contact.get('mail', 'NONE'))))
-            self.contact_table.setItem(i, 3, QTableWidgetItem(
-                str(contact.get('businessPhones', 'NONE'))))
-            self.contact_table.setItem(i, 4, QTableWidgetItem(
-                str(contact.get('mobilePhone', 'NONE'))))
-            self.contact_table.setItem(i, 5, QTableWidgetItem(
-                str(contact.get('department', 'NONE'))))
-            self.contact_table.setItem(i, 6, QTableWidgetItem(
-                str(contact.get('jobTitle', 'NONE'))))
-            self.contact_table.setItem(i, 7, QTableWidgetItem(
-                str(contact.get('officeLocation', 'NONE'))))
+        # The table edits a copy, so self.contacts keeps matching the CSV file
+        self.contact_model.set_rows([dict(contact) for contact in self.contacts])
 
     def populate_user_table(self):
         '''This method populates the user table with the users from the Graph API.'''
-        # Set the number of rows in the user table to the number of users
-        self.user_table.setRowCount(len(self.users))
-
-        # Iterate over the users
-        for i, user in enumerate(self.users):
-            # Create a checkbox item for each user
-            chkBoxItem = QTableWidgetItem()
-
-            # Set the flags of the checkbox item to be user checkable and enabled
-            chkBoxItem.setFlags(Qt.ItemIsUserCheckable | Qt.ItemIsEnabled)
-
-            # If the user's ID is in the list of checked users, set the checkbox to checked; otherwise, set it to unchecked
-            chkBoxItem.setCheckState(Qt.Checked if user.get(
-                'id') in self.checked_users else Qt.Unchecked)
-
-            # Add the checkbox item to the first column of the user table
-            self.user_table.setItem(i, 0, chkBoxItem)
-
-            # For each user, set the item in each column of the user table to the corresponding attribute of the user
-            # If the attribute does not exist for the user, set the item to 'NONE'
-            self.user_table.setItem(i, 1, QTableWidgetItem(
-                str(user.get('givenName', 'NONE'))))
-            self.user_table.setItem(i, 2, QTableWidgetItem(
-                str(user.get('surname', 'NONE'))))
-            self.user_table.setItem(i, 3, QTableWidgetItem(
-                str(user.get('mail', 'NONE'))))
-            self.user_table.setItem(i, 4, QTableWidgetItem(
-                str(user.get('businessPhones', 'NONE'))))
-            self.user_table.setItem(i, 5, QTableWidgetItem(
-                str(user.get('mobilePhone', 'NONE'))))
-            self.user_table.setItem(i, 6, QTableWidgetItem(
-                str(user.get('department', 'NONE'))))
-            self.user_table.setItem(i, 7, QTableWidgetItem(
-                str(user.get('jobTitle', 'NONE'))))
-            self.user_table.setItem(i, 8, QTableWidgetItem(
-                str(user.get('officeLocation', 'NONE'))))
-
-            # add the user id as a hidden item
-            self.user_table.setItem(i, 9, QTableWidgetItem(
-                str(user.get('id', 'NONE'))))
+        # The model keeps the checked state; users whose ID is in the set of checked users start checked.
+        # Rows and checked state go in with one reset, which is cheap however many users there are,
+        # since the view only asks the model for the cells it shows.
+        self.user_model.set_rows(self.users, self.checked_users)
+
+    def set_contacts(self, contacts):
+        '''This method stores the contacts loaded by the LoadThread and shows them in the contact table.'''
+        self.contacts = contacts
+        self.populate_contact_table()
+        self.save_list_btn.setEnabled(True)
+        self.refresh_list_btn.setEnabled(True)
+
+    def set_users(self, users):
+        '''This method stores the users loaded by the LoadThread and shows them in the user table.'''
+        self.users = users
+        self.users_loaded = True
+        self.rebuild_user_index()
+        self.populate_user_table()
+        self.users_header.setText("User List")
+        self.sync_contacts_btn.setEnabled(True)
+        self.update_contact_list_btn.setEnabled(True)
+
+    def rebuild_user_index(self):
+        '''This method indexes the users by their mail address. Call it whenever self.users is replaced.'''
+        # Built in reverse so the first user with a given mail wins, as the old linear search did
+        self.users_by_mail = {user.get('mail'): user for user in reversed(self.users)}
 
     def closeEvent(self, event):
         '''This method is called when the window is about to close. It saves the checked states of the users to a file and accepts the close event.'''
-        # Save the checked states of the users
-        self.save_checked_states()
+        # Give a load that is about to finish a moment, but don't hang the window on a stalled Graph call
+        self.load_thread.wait(LOAD_WAIT_MS)
+        # Save the checked states of the users, unless they never loaded and the table is empty
+        if self.users_loaded:
+            self.save_checked_states()
         # Accept the close event
         event.accept()
 
     def save_checked_states(self):
         '''This method saves the checked states of the users to a file.'''
-        # Create a list of the IDs of the users whose checkboxes are checked
-        checked_users = [self.users[i].get('id') for i in range(
-            self.user_table.rowCount()) if self.user_table.item(i, 0).checkState() == Qt.Checked]
-
-        # Open the file for writing with explicit encoding
-        with open(self.checked_users_file, 'w', encoding='utf-8') as f:
-            # Dump the list of checked user IDs to the file in JSON format
-            json.dump(checked_users, f)
+        # The model tracks the checked user IDs as they change, so there are no rows to scan
+        checked_users = self.user_model.checked_ids()
+        # Nothing to write if they are the same as when they were loaded or last saved
+        if checked_users == self.checked_users:
+            return
+
+        # Dump the list of checked user IDs to a temporary file as UTF-8 JSON, then swap it in
+        # so a crash mid-write can't leave a truncated file behind
+        temp_file = self.checked_users_file + '.tmp'
+        Path(temp_file).write_bytes(json_dumps(list(checked_users)))
+        os.replace(temp_file, self.checked_users_file)
+        self.checked_users = checked_users
 
     def load_checked_states(self):
         '''This method loads the checked states of the users from a file.'''
-        # Initialize the list of checked user IDs
-        self.checked_users = []
+        # Initialize the set of checked user IDs
+        self.checked_users = set()
 
         # Check if the file exists and is not empty
         if os.path.exists(self.checked_users_file) and os.path.getsize(self.checked_users_file) > 0:
             try:
-                # Open the file for reading
-                with open(self.checked_users_file, 'r', encoding='utf-8') as f:
-                    # Load the list of checked user IDs from the file
-                    self.checked_users = json.load(f)
+                # Load the list of checked user IDs from the file, kept as a set for fast lookups
+                self.checked_users = set(json_loads(
+                    Path(self.checked_users_file).read_bytes()))
             except json.JSONDecodeError as e:
                 # Print an error message and exit the method if the file could not be read
                 print(f"Error loading checked states: {e}")
@@ -255,75 +434,77 @@ class UserSyncGUI(QWidget):
 
     def check_all_user_table(self):
         '''This method checks all the checkboxes in the user table'''
-        # Iterate over the rows in the user table
-        for i in range(self.user_table.rowCount()):
-            # Set the check state of the checkbox in the first column of the current row to checked
-            self.user_table.item(i, 0).setCheckState(Qt.Checked)
+        self.user_model.set_all_checked(True)
 
     def uncheck_all_user_table(self):
         '''This method unchecks all the checkboxes in the user table'''
-
-        # Iterate over the rows in the user table
-        for i in range(self.user_table.rowCount()):
-            # Set the check state of the checkbox in the first column of the current row to unchecked
-            self.user_table.item(i, 0).setCheckState(Qt.Unchecked)
+        self.user_model.set_all_checked(False)
 
     def save_contact_list(self):
         """This method saves the contact list to the CSV file"""
 
         # Update the contact list with the data in the contact table
         updated_contacts = []
-        headers = ['givenName', 'surname', 'mail', 'businessPhones',
-                   'mobilePhone', 'department', 'jobTitle', 'officeLocation']
-        for row in range(self.contact_table.rowCount()):
+        # Bind the lookups used for every cell to locals
+        model = self.contact_table.model()
+        index = model.index
+        fmt = self.format_phone_number
+        columns = tuple(enumerate(CONTACT_COLS))
+        for row in range(model.rowCount()):
             contact = {}
             is_empty_row = True
-            for col in range(self.contact_table.columnCount()):
-                value = self.contact_table.item(row, col).text()
+            for col, key in columns:
+                value = index(row, col).data()
                 if value:
                     is_empty_row = False
-                if headers[col] == 'businessPhones':
-                    # Remove the square brackets and convert to string
-                    value = value.strip("['']")
-                    # Format the phone number
-                    value = self.format_phone_number(value)
-                    if not value:
-                        value = None
-                elif headers[col] == 'mobilePhone':
+                if col == BUSINESS_PHONE_COL:
+                    # Remove the square brackets and format the phone number
+                    value = fmt(value.strip("['']")) or None
+                elif col == MOBILE_PHONE_COL:
                     # Format the phone number
-                    value = self.format_phone_number(value)
-                contact[headers[col]] = value
+                    value = fmt(value)
+                contact[key] = value
             if not is_empty_row:
                 updated_contacts.append(contact)
 
         # Use ContactSync to write the updated contacts to the CSV file
         self.contact_sync.write_to_csv(updated_contacts, self.csv_file_path)
+        # Keep the cached contacts in step with the file so the sync doesn't need to re-read it.
+        # The csv module writes None as an empty field, so cache it the way it reads back.
+        self.contacts = [{key: '' if value is None else value for key, value in contact.items()}
+                         for contact in updated_contacts]
 
     def format_phone_number(self, phone_number):
-        """This method formats the phone number to the format (XXX) XXX-XXXX. If the phone number is empty, it returns None."""
+        """This method formats the phone number to the format (XXX) XXX-XXXX. If the phone number is empty, it returns None.
+        A leading 1 (the NANP country code) is dropped; any other number that isn't 10 digits is returned as entered."""
         # Remove any non-digit characters from the phone number
-        phone_number = re.sub(r'\D', '', phone_number)
+        digits = NON_DIGIT_RE.sub('', phone_number)
         # If the phone number is empty, return None
-        if not phone_number:
+        if not digits:
             return None
+        # Drop the NANP country code
+        if len(digits) == 11 and digits[0] == '1':
+            digits = digits[1:]
+        # Extensions, short numbers and international numbers can't be formatted, keep what the user typed
+        if len(digits) != 10:
+            return phone_number.strip()
 
         # Format the phone number
-        formatted_phone_number = f"({phone_number[0:3]}) {
-            phone_number[3:6]}-{phone_number[6:]}"
-
-        return formatted_phone_number
+        return f"({digits[0:3]}) {digits[3:6]}-{digits[6:10]}"
 
     def update_contact_list(self):
         """
-        This method updates the contact list by pulling the latest users from the Graph API and filtering them.
+        This method opens the Global Address List window with the users already loaded, to pick contacts from.
         """
-        self.gal_window = GALWindow(self.contact_sync, self.contact_table)
+        self.gal_window = GALWindow(
+            self.contact_sync, self.contact_model, self.users)
         self.gal_window.show()
 
     def refresh_contact_list(self):
         '''This method refreshes the contact list by reloading the contacts from the CSV file and repopulating the contact table.'''
         # Reload the contacts from the CSV file
-        self.contacts = self.contact_sync.read_csv_file(self.csv_file_path)
+        self.contacts = list(
+            self.contact_sync.read_csv_file(self.csv_file_path))
 
         # Repopulate the contact table with the reloaded contacts
         self.populate_contact_table()
@@ -331,29 +512,30 @@ class UserSyncGUI(QWidget):
     def get_contacts_from_table(self):
         '''This method retrieves the contacts from the contact table and returns them as a list of dictionaries.'''
         contacts = []
-        for row in range(self.contact_table.rowCount()):
+        model = self.contact_table.model()
+        for row in range(model.rowCount()):
             contact = {}
             # Assuming 'email' is in the third column
-            email = self.contact_table.item(row, 2).text()
+            email = model.index(row, 2).data()
             # Assuming 'phone' is in the fourth column
-            mobile = self.contact_table.item(row, 3).text()
+            mobile = model.index(row, 3).data()
             # Assuming 'department' is in the fifth column
-            business_phone = self.contact_table.item(row, 4).text()
+            business_phone = model.index(row, 4).data()
 
             # Assuming 'name' is in the second column
-            contact['givenName'] = self.contact_table.item(row, 0).text()
-            contact['surname'] = self.contact_table.item(row, 1).text()
+            contact['givenName'] = model.index(row, 0).data()
+            contact['surname'] = model.index(row, 1).data()
             contact['displayName'] = contact['givenName'] + \
                 ' ' + contact['surname']
             contact['emailAddresses'] = [
                 {'name': contact['givenName'] + ' ' + contact['surname'], 'address': email}]
             contact['mobilePhone'] = mobile
             contact['businessPhones'] = [business_phone]
-            contact['department'] = self.contact_table.item(row, 5).text()
+            contact['department'] = model.index(row, 5).data()
 
-            contact['officeLocation'] = self.contact_table.item(row, 7).text()
+            contact['officeLocation'] = model.index(row, 7).data()
 
-            contact['JobTitle'] = self.contact_table.item(row, 6).text()
+            contact['JobTitle'] = model.index(row, 6).data()
 
             contacts.append(contact)
         return contacts
@@ -361,14 +543,14 @@ class UserSyncGUI(QWidget):
     def get_selected_users_from_table(self):
         '''This method retrieves the selected users from the user table and returns them as a list of dictionaries.'''
         selected_users = []
-        for row in range(self.user_table.rowCount()):
+        model = self.user_table.model()
+        for row in range(model.rowCount()):
             # If the checkbox is checked
-            if self.user_table.item(row, 0).checkState() == Qt.Checked:
+            if model.index(row, 0).data(Qt.CheckStateRole) == Qt.Checked:
                 # Assuming email is displayed in the 3rd column
-                email = self.user_table.item(row, 3).text()
+                email = model.index(row, 3).data()
                 # Use 'mail' field instead of 'email' to match with Graph API user data structure
-                user_info = next(
-                    (user for user in self.users if user.get('mail') == email), None)
+                user_info = self.users_by_mail.get(email)
                 if user_info:
                     # Modify the user_info dictionary to match the desired format
                     modified_user_info = {
@@ -388,21 +570,20 @@ class UserSyncGUI(QWidget):
         return selected_users
 
     def start_sync_process(self):
-        '''This method starts the sync process by creating a SyncThread and starting it. It also creates a SyncStatusWindow to display the sync status.'''
+        '''This method starts the sync process by creating a SyncRunnable and starting it on the global thread pool. It also creates a SyncStatusWindow to display the sync status.'''
         self.sync_status_window = SyncStatusWindow()
         self.sync_status_window.show()
 
-        # Fetch contacts and users data before starting the thread
-        contacts = self.contact_sync.format_contact_list(
-            self.contact_sync.read_csv_file(self.csv_file_path))
+        # Format the cached CSV contacts instead of reading the file again
+        contacts = list(self.contact_sync.format_contact_list(self.contacts))
         # de-serialize the contacts prior to passing to the sync function
         selected_users = self.get_selected_users_from_table()
-        # Pass the contacts and selected users to the SyncThread
-        self.sync_thread = SyncThread(
+        # Pass the contacts and selected users to the SyncRunnable
+        self.sync_runnable = SyncRunnable(
             self.sync_contacts_button, contacts, selected_users)
-        self.sync_thread.update_signal.connect(
+        self.sync_runnable.signals.update_signal.connect(
             self.sync_status_window.update_status)
-        self.sync_thread.start()
+        QThreadPool.globalInstance().start(self.sync_runnable)
 
     def sync_contacts_button(self, contacts, users):
         '''This method is called when the sync button is clicked. It processes the contacts and users to sync them.'''
@@ -412,10 +593,11 @@ class UserSyncGUI(QWidget):
 class GALWindow(QMainWindow):
     '''This class represents the Global Address List window. It is a subclass of QMainWindow and is used to display the Global Address List.'''
 
-    def __init__(self, contact_sync, contact_table):
+    def __init__(self, contact_sync, contact_model, users):
         super().__init__()
         self.contact_sync = contact_sync
-        self.contact_table = contact_table
+        self.contact_model = contact_model
+        self.users = users
         self.initUI()
 
     def initUI(self):
@@ -426,7 +608,10 @@ class GALWindow(QMainWindow):
         self.setCentralWidget(self.central_widget)  # Set the central widget
         layout = QVBoxLayout(self.central_widget)  # Create a vertical layout
 
-        self.gal_table = QTableWidget()  # Create a table widget
+        self.gal_model = DictTableModel(  # Create the model with the column headers
+            CONTACT_HEADERS, CONTACT_COLS, parent=self)
+        self.gal_table = QTableView()  # Create a table view
+        self.gal_table.setModel(self.gal_model)
         layout.addWidget(self.gal_table)  # Add the table to the layout
 
         self.gal_table.setSelectionMode(
@@ -434,10 +619,6 @@ class GALWindow(QMainWindow):
         self.gal_table.setSelectionBehavior(
             QAbstractItemView.SelectRows)  # Set the selection behavior
 
-        self.gal_table.setColumnCount(8)  # Set the number of columns
-        self.gal_table.setHorizontalHeaderLabels(  # Set the column headers
-            ['Given Name', 'Surname', 'Email', 'Business Phone', 'Mobile', 'Department', 'Job Title', 'Office Location'])
-
         # Populate the table with all users (dummy function, implement fetching logic)
         self.populate_gal_table()
 
@@ -451,6 +632,10 @@ class GALWindow(QMainWindow):
         clear_selected_btn = QPushButton('Clear Selected')
         # Connect the button to the clear_selected method
         clear_selected_btn.clicked.connect(self.clear_selected)
+        # Create a button to fetch the latest users from the Graph API
+        self.refresh_btn = QPushButton('Refresh')
+        # Connect the button to the refresh_gal_table method
+        self.refresh_btn.clicked.connect(self.refresh_gal_table)
         # Create a button to add the selected users to the contact list
         add_to_list_btn = QPushButton('Add to Contact List')
         # Connect the button to the add_to_contact_list method
@@ -460,6 +645,8 @@ class GALWindow(QMainWindow):
         buttons_layout.addWidget(select_all_btn)
         # Add the clear selected button to the layout
         buttons_layout.addWidget(clear_selected_btn)
+        # Add the refresh button to the layout
+        buttons_layout.addWidget(self.refresh_btn)
         # Add the add to contact list button to the layout
         buttons_layout.addWidget(add_to_list_btn)
 
@@ -467,41 +654,41 @@ class GALWindow(QMainWindow):
         layout.addLayout(buttons_layout)
 
     def populate_gal_table(self):
-        '''This method populates the Global Address List table with the users from the Graph API.'''
-        users = self.contact_sync.filter_users()
-        self.gal_table.setRowCount(len(users))
-        for i, user in enumerate(users):
-            self.gal_table.setItem(i, 0, QTableWidgetItem(
-                str(user.get('givenName', 'NONE'))))
-            self.gal_table.setItem(i, 1, QTableWidgetItem(
-                str(user.get('surname', 'NONE'))))
-            self.gal_table.setItem(i, 2, QTableWidgetItem(
-                str(user.get('mail', 'NONE'))))
-            self.gal_table.setItem(i, 3, QTableWidgetItem(
-                str(user.get('businessPhones', 'NONE'))))
-            self.gal_table.setItem(i, 4, QTableWidgetItem(
-                str(user.get('mobilePhone', 'NONE'))))
-            self.gal_table.setItem(i, 5, QTableWidgetItem(
-                str(user.get('department', 'NONE'))))
-            self.gal_table.setItem(i, 6, QTableWidgetItem(
-                str(user.get('jobTitle', 'NONE'))))
-            self.gal_table.setItem(i, 7, QTableWidgetItem(
-                str(user.get('officeLocation', 'NONE'))))
+        '''This method populates the Global Address List table with the users already loaded by the main window.'''
+        self.gal_model.set_rows(self.users)
+
+    def refresh_gal_table(self):
+        '''This method pulls the latest users from the Graph API in the background. The table is repopulated when they arrive.'''
+        # Only one refresh at a time
+        self.refresh_btn.setEnabled(False)
+        self.users_runnable = UsersRunnable(self.contact_sync)
+        self.users_runnable.signals.users_signal.connect(self.set_users)
+        self.users_runnable.signals.error_signal.connect(self.refresh_failed)
+        QThreadPool.globalInstance().start(self.users_runnable)
+
+    def set_users(self, users):
+        '''This method stores the refreshed users and repopulates the Global Address List table.'''
+        self.users = users
+        self.populate_gal_table()
+        self.refresh_btn.setEnabled(True)
+
+    def refresh_failed(self, message):
+        '''This method reports a failed refresh and keeps the users already shown.'''
+        print(f"Error refreshing users: {message}")
+        self.refresh_btn.setEnabled(True)
 
     def select_all(self):
         '''This method selects all users in the Global Address List table.'''
         # Get the table's selection model
         selectionModel = self.gal_table.selectionModel()
 
-        # Clear current selection for a clean state
-        selectionModel.clearSelection()
-
-        # Create a selection that includes all rows
-        for row in range(self.gal_table.rowCount()):
-            # Get index of first column in each row
-            index = self.gal_table.model().index(row, 0)
+        # Select every row with a single selection range, so the view gets one selection change instead of one per row
+        row_count = self.gal_model.rowCount()
+        if row_count:
+            selection = QItemSelection(self.gal_model.index(0, 0),
+                                       self.gal_model.index(row_count - 1, 0))
             selectionModel.select(
-                index, QItemSelectionModel.Select | QItemSelectionModel.Rows)
+                selection, QItemSelectionModel.ClearAndSelect | QItemSelectionModel.Rows)
 
         # Ensure the table has focus to show the selection highlight
         self.gal_table.setFocus()
@@ -516,21 +703,18 @@ class GALWindow(QMainWindow):
         # Add selected users to the main window's contact table
         selected_rows = self.gal_table.selectionModel().selectedRows()
 
-        # clear the contact table
-        self.contact_table.setRowCount(0)
-
+        row_text = self.gal_model.row_text
+        contacts = []
         for row in selected_rows:
             # Get the user data from the selected row
-            user_data = [self.gal_table.item(row.row(), col).text()
-                         for col in range(self.gal_table.columnCount())]
+            user_data = row_text(row.row())
 
             # Modify the user data to get the first value from businessPhones list
             user_data[3] = user_data[3].split(',')[0]
 
-            # Add the user data to the contact table
-            self.contact_table.insertRow(self.contact_table.rowCount())
-            for col, data in enumerate(user_data):
-                self.contact_table.setItem(
-                    self.contact_table.rowCount() - 1, col, QTableWidgetItem(data))
+            contacts.append(dict(zip(CONTACT_COLS, user_data)))
+
+        # Replace the contact table with the selected users in one reset
+        self.contact_model.set_rows(contacts)
 
         self.close()